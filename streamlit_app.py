@@ -1,12 +1,21 @@
+import io
 import os
+import csv
 import hmac
+import atexit
 import hashlib
 import binascii
+import functools
 from datetime import date
 
+import pyarrow as pa
 import streamlit as st
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError, VerifyMismatchError
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.errors import ForeignKeyViolation
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import ConnectionPool
 
 
 # ----------------------------
@@ -28,8 +37,14 @@ st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 
 # ----------------------------
-# DB URL
+# SETTINGS / DB URL
 # ----------------------------
+def get_setting(name: str, default=None):
+    if name in st.secrets:
+        return st.secrets[name]
+    return os.getenv(name, default)
+
+
 def get_db_url() -> str:
     if "DB_URL" in st.secrets:
         return st.secrets["DB_URL"]
@@ -41,96 +56,180 @@ def get_db_url() -> str:
 
 DB_URL = get_db_url()
 
+# Detrás de PgBouncer en modo transacción (p.ej. Supabase :6543) no sirven los prepared statements.
+DB_PGBOUNCER = str(get_setting("DB_PGBOUNCER", "")).lower() in ("1", "true", "yes")
+
 
 # ----------------------------
-# DB CONNECTION (psycopg v3)
+# DB CONNECTION (psycopg v3 + pool)
 # ----------------------------
+@st.cache_resource(show_spinner=False)
+def get_pool() -> ConnectionPool:
+    """
+    Pool único por proceso: evita el handshake TCP+TLS+auth en cada consulta.
+    """
+    kwargs = {"sslmode": "require", "row_factory": dict_row, "connect_timeout": 10}
+    if DB_PGBOUNCER:
+        kwargs["prepare_threshold"] = None
+    max_size = int(get_setting("DB_POOL_MAX", 10))
+    # max_idle: cierra conexiones ociosas >5 min (un proxy intermedio puede haberlas cortado).
+    pool = ConnectionPool(
+        DB_URL, min_size=min(2, max_size), max_size=max_size, max_idle=300, kwargs=kwargs, open=True
+    )
+    atexit.register(pool.close)
+    return pool
+
+
 def db_conn():
-    return psycopg.connect(DB_URL, sslmode="require", row_factory=dict_row)
+    return get_pool().connection()
 
 
-def run_exec(sql: str, params=None):
+# prepare=True: PREPARE desde la primera ejecución (para SQL de forma fija).
+# Con DB_PGBOUNCER se ignora.
+def prepare_flag(prepare):
+    return None if DB_PGBOUNCER else prepare
+
+
+def run_exec(sql: str, params=None, prepare=None) -> int:
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, params)
+            cur.execute(sql, params, prepare=prepare_flag(prepare))
+            rowcount = cur.rowcount
         conn.commit()
+    return rowcount
 
 
-def run_fetchall(sql: str, params=None):
+def run_fetchall(sql: str, params=None, prepare=None):
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, params)
+            cur.execute(sql, params, prepare=prepare_flag(prepare))
             return cur.fetchall()
 
 
-def run_fetchone(sql: str, params=None):
-    rows = run_fetchall(sql, params)
+def run_fetchone(sql: str, params=None, prepare=None):
+    rows = run_fetchall(sql, params, prepare=prepare)
     return rows[0] if rows else None
 
 
+def rows_to_arrow(rows: list, columns: list) -> pa.Table:
+    """Filas (tuplas) -> tabla Arrow columna a columna, sin pasar por pandas."""
+    data = list(zip(*rows)) if rows else [[] for _ in columns]
+    return pa.table({name: pa.array(list(col)) for name, col in zip(columns, data)})
+
+
+def run_fetch_table(sql: str, params=None, prepare=None) -> pa.Table:
+    with db_conn() as conn:
+        with conn.cursor(row_factory=tuple_row) as cur:
+            cur.execute(sql, params, prepare=prepare_flag(prepare))
+            columns = [c.name for c in cur.description]
+            return rows_to_arrow(cur.fetchall(), columns)
+
+
+def run_fetch_count_table(count_sql: str, sql: str, params=None, prepare=None):
+    """
+    COUNT + página en un solo round-trip (pipeline mode).
+    count_sql debe devolver una columna "total". Retorna (total, tabla Arrow).
+    """
+    with db_conn() as conn:
+        with conn.cursor() as c_count, conn.cursor(row_factory=tuple_row) as c_rows:
+            with conn.pipeline():
+                c_count.execute(count_sql, params, prepare=prepare_flag(prepare))
+                c_rows.execute(sql, params, prepare=prepare_flag(prepare))
+            total = c_count.fetchone()["total"]
+            columns = [c.name for c in c_rows.description]
+            return total, rows_to_arrow(c_rows.fetchall(), columns)
+
+
 # ----------------------------
-# PASSWORD HASH (PBKDF2)
+# PASSWORD HASH (argon2id; PBKDF2 legado)
 # ----------------------------
-def hash_password(password: str, salt: bytes = None) -> str:
-    if salt is None:
-        salt = os.urandom(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120_000)
-    return f"pbkdf2_sha256$120000${binascii.hexlify(salt).decode()}${binascii.hexlify(dk).decode()}"
+PASSWORD_HASHER = PasswordHasher(
+    time_cost=int(get_setting("ARGON2_TIME_COST", 2)),
+    memory_cost=int(get_setting("ARGON2_MEMORY_KIB", 19456)),
+    parallelism=1,
+)
+
+
+def hash_password(password: str) -> str:
+    return PASSWORD_HASHER.hash(password)
+
+
+# Los hashes legados usan 120000 iteraciones; un valor mayor es un hash corrupto.
+PBKDF2_MAX_ITERATIONS = 1_000_000
+
+
+def verify_password_pbkdf2(password: str, stored: str) -> bool:
+    """Formato legado pbkdf2_sha256$iters$salt$dk. ValueError/TypeError si está mal formado."""
+    algo, iters, salt_hex, dk_hex = stored.split("$")
+    if algo != "pbkdf2_sha256":
+        raise ValueError("no es un hash pbkdf2_sha256")
+    iters = int(iters)
+    if not 1 <= iters <= PBKDF2_MAX_ITERATIONS:
+        raise ValueError("iteraciones pbkdf2 fuera de rango")
+    salt = binascii.unhexlify(salt_hex)
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iters)
+    return hmac.compare_digest(binascii.hexlify(dk).decode(), dk_hex)
+
+
+def verify_dummy_password(password: str):
+    """Verify completo contra el hash falso; el resultado no importa, solo el costo."""
+    try:
+        PASSWORD_HASHER.verify(dummy_password_hash(), password)
+    except (VerificationError, ValueError):
+        pass
 
 
 def verify_password(password: str, stored: str) -> bool:
+    if not password:
+        return False
     try:
-        algo, iters, salt_hex, dk_hex = stored.split("$")
-        if algo != "pbkdf2_sha256":
-            return False
-        salt = binascii.unhexlify(salt_hex)
-        dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, int(iters))
-        return hmac.compare_digest(binascii.hexlify(dk).decode(), dk_hex)
-    except Exception:
+        if stored.startswith("pbkdf2_sha256$"):
+            return verify_password_pbkdf2(password, stored)
+        return PASSWORD_HASHER.verify(stored, password)
+    except VerifyMismatchError:
+        return False
+    except (InvalidHashError, VerificationError, ValueError, TypeError, OverflowError):
+        # Hash guardado ilegible (corrupto, truncado, no ASCII): igual se paga
+        # un verify completo, para que el tiempo no lo distinga de una clave
+        # incorrecta.
+        verify_dummy_password(password)
         return False
 
 
+@st.cache_resource(show_spinner=False)
+def dummy_password_hash() -> str:
+    """Hash de una clave aleatoria, mismo costo que uno real."""
+    return hash_password(binascii.hexlify(os.urandom(16)).decode())
+
+
+def password_needs_rehash(stored: str) -> bool:
+    """True para hashes PBKDF2 legados o argon2 con parámetros viejos."""
+    return not stored.startswith("$argon2") or PASSWORD_HASHER.check_needs_rehash(stored)
+
+
 # ----------------------------
 # SCHEMA HELPERS
 # ----------------------------
-def column_exists(table: str, column: str) -> bool:
-    row = run_fetchone(
+@st.cache_resource(show_spinner=False)
+def table_columns(table: str) -> frozenset:
+    """
+    Columnas de una tabla de public. Se cachea por proceso y se invalida
+    con table_columns.clear() después de cualquier DDL.
+    """
+    rows = run_fetchall(
         """
-        SELECT 1
+        SELECT column_name
         FROM information_schema.columns
         WHERE table_schema = 'public'
-          AND table_name = %s
-          AND column_name = %s
-        LIMIT 1;
+          AND table_name = %s;
         """,
-        (table, column),
+        (table,),
     )
-    return bool(row)
-
+    return frozenset(r["column_name"] for r in rows)
 
-def ensure_users_schema():
-    """
-    Asegura que exista la tabla users y las columnas mínimas que necesitamos.
-    Respeta tu esquema si ya existe (por ejemplo, role NOT NULL).
-    """
-    run_exec("""
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        is_admin BOOLEAN NOT NULL DEFAULT FALSE,
-        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-    );
-    """)
 
-    if not column_exists("users", "password_hash"):
-        run_exec("ALTER TABLE users ADD COLUMN IF NOT EXISTS password_hash TEXT;")
-
-    if not column_exists("users", "is_admin"):
-        run_exec("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT FALSE;")
-
-    if not column_exists("users", "created_at"):
-        run_exec("ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+def column_exists(table: str, column: str) -> bool:
+    return column in table_columns(table)
 
 
 def seed_admin():
@@ -142,66 +241,160 @@ def seed_admin():
 
     # Si tu esquema usa role, consideramos admin si role='admin'
     if has_role:
-        existing = run_fetchone("SELECT id FROM users WHERE role = 'admin' LIMIT 1;")
-        if not existing:
-            run_exec(
-                """
-                INSERT INTO users (username, password_hash, role)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (username) DO NOTHING;
-                """,
-                ("admin", hash_password("Admin1234!"), "admin"),
-            )
+        check_sql = "SELECT id FROM users WHERE role = 'admin' LIMIT 1;"
+        insert_sql = """
+            INSERT INTO users (username, password_hash, role)
+            VALUES (%s, %s, 'admin')
+            ON CONFLICT (username) DO NOTHING;
+        """
     else:
-        existing = run_fetchone("SELECT id FROM users WHERE is_admin = TRUE LIMIT 1;")
-        if not existing:
-            run_exec(
-                """
-                INSERT INTO users (username, password_hash, is_admin)
-                VALUES (%s, %s, TRUE)
-                ON CONFLICT (username) DO NOTHING;
-                """,
-                ("admin", hash_password("Admin1234!")),
-            )
+        check_sql = "SELECT id FROM users WHERE is_admin = TRUE LIMIT 1;"
+        insert_sql = """
+            INSERT INTO users (username, password_hash, is_admin)
+            VALUES (%s, %s, TRUE)
+            ON CONFLICT (username) DO NOTHING;
+        """
+
+    # Lectura + inserción en una sola conexión/transacción.
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(check_sql)
+            if cur.fetchone() is None:
+                cur.execute(insert_sql, ("admin", hash_password("Admin1234!")))
+        conn.commit()
 
 
-def init_db():
+# Un solo string => un solo round-trip (psycopg acepta varias sentencias sin parámetros).
+# Respeta tu esquema si ya existe (por ejemplo, users.role NOT NULL).
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS password_hash TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+CREATE TABLE IF NOT EXISTS machines (
+    id_maquina INTEGER PRIMARY KEY,
+    fabricante TEXT NOT NULL,
+    sector TEXT NOT NULL,
+    banco TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+-- Búsqueda del historial y filtro de Máquinas: un solo ILIKE indexable en vez
+-- de uno por columna. Al ir todo concatenado, un patrón también calza a través
+-- de columnas (p. ej. "IGT Terraza" = fabricante + sector).
+ALTER TABLE machines ADD COLUMN IF NOT EXISTS search_blob TEXT GENERATED ALWAYS AS (
+    id_maquina::text || ' ' || coalesce(fabricante, '') || ' ' || coalesce(sector, '') || ' ' || coalesce(banco, '')
+) STORED;
+
+CREATE TABLE IF NOT EXISTS mantenciones (
+    id SERIAL PRIMARY KEY,
+    id_maquina INTEGER NOT NULL,
+    tipo TEXT NOT NULL,
+    descripcion TEXT NOT NULL,
+    fecha DATE NOT NULL,
+    realizado_por TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT fk_mantenciones_machine
+        FOREIGN KEY (id_maquina)
+        REFERENCES machines(id_maquina)
+        ON UPDATE CASCADE
+        ON DELETE RESTRICT
+);
+
+-- Historial: rango por fecha + ORDER BY fecha DESC, id DESC.
+CREATE INDEX IF NOT EXISTS mantenciones_fecha_id_idx ON mantenciones (fecha DESC, id DESC);
+-- JOIN / FK hacia machines (y DELETE de machines con ON DELETE RESTRICT).
+CREATE INDEX IF NOT EXISTS mantenciones_id_maquina_idx ON mantenciones (id_maquina);
+-- Historial filtrado por tipo: mismo orden que el listado.
+CREATE INDEX IF NOT EXISTS mantenciones_tipo_fecha_id_idx ON mantenciones (tipo, fecha DESC, id DESC);
+"""
+
+# Índices trigram para los ILIKE '%...%'. Van aparte: CREATE EXTENSION puede
+# requerir permisos que el rol de la app no tiene, y sin ellos las tablas y
+# el admin igual deben crearse (las búsquedas funcionan, solo sin índice).
+TRGM_DDL = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS machines_search_blob_trgm_idx ON machines USING gin (search_blob gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS mantenciones_descripcion_trgm_idx ON mantenciones USING gin (descripcion gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS mantenciones_realizado_por_trgm_idx ON mantenciones USING gin (realizado_por gin_trgm_ops);
+"""
+
+
+# Se guarda como COMMENT de mantenciones. Súbela cada vez que cambie SCHEMA_DDL
+# o TRGM_DDL.
+SCHEMA_VERSION = "kr_tgm schema v2"
+
+
+SCHEMA_PROBE_SQL = "SELECT obj_description(to_regclass('public.mantenciones'), 'pg_class') AS version;"
+
+
+def schema_is_current() -> bool:
+    """Sonda barata (sin DDL): ¿la BD ya tiene SCHEMA_VERSION aplicada?"""
+    row = run_fetchone(SCHEMA_PROBE_SQL)
+    return bool(row) and row["version"] == SCHEMA_VERSION
+
+
+def apply_schema() -> bool:
     """
-    Crea tablas si no existen.
-    Mantiene id_maquina como INTEGER.
+    Aplica SCHEMA_DDL bajo un advisory lock de transacción: si varios
+    procesos arrancan a la vez, uno ejecuta el DDL y el resto espera y
+    luego ve la versión ya aplicada.
+    TRGM_DDL corre en un savepoint: si falla (sin permiso para pg_trgm) se
+    descarta solo esa parte, la versión no se marca (se reintenta en el
+    próximo arranque) y se devuelve False.
     """
-    try:
-        ensure_users_schema()
+    trgm_ok = True
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('kr_tgm_bootstrap'));")
+            cur.execute(SCHEMA_PROBE_SQL)
+            row = cur.fetchone()
+            if not row or row["version"] != SCHEMA_VERSION:
+                cur.execute(SCHEMA_DDL)
+                try:
+                    with conn.transaction():
+                        cur.execute(TRGM_DDL)
+                except psycopg.Error:
+                    trgm_ok = False
+                if trgm_ok:
+                    cur.execute(f"COMMENT ON TABLE mantenciones IS '{SCHEMA_VERSION}';")
+        conn.commit()
+    return trgm_ok
 
-        run_exec("""
-        CREATE TABLE IF NOT EXISTS machines (
-            id_maquina INTEGER PRIMARY KEY,
-            fabricante TEXT NOT NULL,
-            sector TEXT NOT NULL,
-            banco TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-        """)
 
-        run_exec("""
-        CREATE TABLE IF NOT EXISTS mantenciones (
-            id SERIAL PRIMARY KEY,
-            id_maquina INTEGER NOT NULL,
-            tipo TEXT NOT NULL,
-            descripcion TEXT NOT NULL,
-            fecha DATE NOT NULL,
-            realizado_por TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            CONSTRAINT fk_mantenciones_machine
-                FOREIGN KEY (id_maquina)
-                REFERENCES machines(id_maquina)
-                ON UPDATE CASCADE
-                ON DELETE RESTRICT
-        );
-        """)
+@st.cache_resource(show_spinner=False)
+def init_schema() -> bool:
+    """
+    Crea tablas/columnas si no existen y siembra el admin.
+    Mantiene id_maquina como INTEGER.
+    Corre una sola vez por proceso (no en cada rerun).
+    También precalcula el hash falso del login, para que el primer intento
+    con un usuario inexistente no pague hash + verify.
+    Devuelve False si no se pudieron crear los índices trigram.
+    """
+    trgm_ok = True
+    if not schema_is_current():
+        trgm_ok = apply_schema()
+        table_columns.clear()
+    seed_admin()
+    dummy_password_hash()
+    return trgm_ok
 
-        seed_admin()
 
+def init_db():
+    try:
+        if not init_schema():
+            st.warning(
+                "No se pudo habilitar la extensión pg_trgm (falta permiso). La app funciona, "
+                "pero las búsquedas son más lentas. Un administrador de la BD debe ejecutar: "
+                "CREATE EXTENSION pg_trgm;"
+            )
     except Exception as e:
         st.warning("No pude ejecutar inicialización completa (CREATE/ALTER). Si las tablas ya existen, puedes ignorarlo. Detalle:")
         st.exception(e)
@@ -236,24 +429,32 @@ def require_admin():
 
 
 def login(username: str, password: str) -> bool:
+    """username ya viene normalizado (strip) desde el formulario."""
     has_role = column_exists("users", "role")
 
     if has_role:
         user = run_fetchone(
             "SELECT id, username, password_hash, role FROM users WHERE username = %s;",
-            (username.strip(),),
+            (username,),
+            prepare=True,
         )
     else:
         user = run_fetchone(
             "SELECT id, username, password_hash, is_admin FROM users WHERE username = %s;",
-            (username.strip(),),
+            (username,),
+            prepare=True,
         )
 
-    if not user or not user.get("password_hash"):
+    # Siempre se verifica un hash (uno falso si el usuario no existe) para
+    # no revelar por tiempo de respuesta qué usuarios existen.
+    stored = user.get("password_hash") if user else None
+    ok = verify_password(password, stored or dummy_password_hash())
+    if not (user and stored and ok):
         return False
 
-    if not verify_password(password, user["password_hash"]):
-        return False
+    # Migración: re-hashea con argon2id al primer login exitoso.
+    if password_needs_rehash(user["password_hash"]):
+        run_exec("UPDATE users SET password_hash = %s WHERE id = %s;", (hash_password(password), user["id"]))
 
     payload = {"id": user["id"], "username": user["username"]}
     if has_role:
@@ -273,17 +474,210 @@ def logout():
 # ----------------------------
 # HELPERS
 # ----------------------------
+# Opciones de widgets: constantes de módulo, no se reconstruyen en cada rerun.
+TIPOS_MANTENCION = ("Preventiva", "Correctiva", "Revisión", "Software", "Otro")
+TIPOS_MANTENCION_SET = frozenset(TIPOS_MANTENCION)
+TIPO_TODOS = "(Todos)"
+TIPOS_FILTRO = (TIPO_TODOS,) + TIPOS_MANTENCION
+HIST_PAGE_SIZES = (50, 100, 300, 1000)
+
+
+# Evita el SELECT en cada rerun; las escrituras llaman clear_machine_caches().
+@st.cache_data(ttl=30, show_spinner=False)
 def run_fetch_machines():
     return run_fetchall("""
         SELECT id_maquina, fabricante, sector, banco
         FROM machines
         ORDER BY id_maquina;
-    """)
+    """, prepare=True)
+
+
+MACHINE_SEARCH_LIMIT = 500
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def search_machines(q: str, limit: int = MACHINE_SEARCH_LIMIT):
+    """
+    Filtro del listado en SQL: ILIKE sobre search_blob (índice trigram)
+    y LIMIT, en vez de traer toda la tabla y filtrar en Python.
+    Sin filtro no hay predicado: ILIKE '%%' no usa el índice y solo
+    estorbaría al plan por la PK.
+    """
+    if not q:
+        return run_fetchall("""
+            SELECT id_maquina, fabricante, sector, banco
+            FROM machines
+            ORDER BY id_maquina
+            LIMIT %s;
+        """, (limit,), prepare=True)
+    return run_fetchall("""
+        SELECT id_maquina, fabricante, sector, banco
+        FROM machines
+        WHERE search_blob ILIKE %s
+        ORDER BY id_maquina
+        LIMIT %s;
+    """, (f"%{q}%", limit), prepare=True)
+
+
+def clear_machine_caches():
+    """Tras escribir en machines: listado, filtro e historial (que hace JOIN)."""
+    run_fetch_machines.clear()
+    search_machines.clear()
+    fetch_historial.clear()
+
 
+MANTENCION_COLS = ("id_maquina", "tipo", "descripcion", "fecha", "realizado_por")
+
+
+def mantenciones_bulk_create(rows: list) -> int:
+    """
+    Inserta muchas mantenciones con COPY (un solo round-trip).
+    rows: tuplas en el orden de MANTENCION_COLS.
+    """
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(f"COPY mantenciones ({', '.join(MANTENCION_COLS)}) FROM STDIN") as cp:
+                for r in rows:
+                    cp.write_row(r)
+        conn.commit()
+    return len(rows)
 
-def machine_exists(id_maquina: int) -> bool:
-    row = run_fetchone("SELECT id_maquina FROM machines WHERE id_maquina = %s;", (int(id_maquina),))
-    return bool(row)
+
+MACHINE_COLS = ("id_maquina", "fabricante", "sector", "banco")
+ID_MAQUINA_MAX = 2147483647  # machines.id_maquina es INTEGER (int32)
+
+MACHINE_MERGE_SQL = """
+    INSERT INTO machines (id_maquina, fabricante, sector, banco)
+    SELECT id_maquina, fabricante, sector, banco
+    FROM machines_import
+    ON CONFLICT (id_maquina) DO UPDATE
+    SET fabricante = EXCLUDED.fabricante,
+        sector = EXCLUDED.sector,
+        banco = EXCLUDED.banco;
+"""
+
+
+def machines_upsert_many(rows: list) -> int:
+    """
+    Crea/actualiza muchas máquinas: COPY a una tabla temporal y un solo
+    INSERT ... ON CONFLICT desde ella.
+    rows: tuplas en el orden de MACHINE_COLS. Si un id_maquina se repite,
+    gana la última fila (ON CONFLICT no admite el mismo id dos veces).
+    """
+    rows = list({r[0]: r for r in rows}.values())
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE machines_import (
+                    id_maquina INTEGER, fabricante TEXT, sector TEXT, banco TEXT
+                ) ON COMMIT DROP;
+            """)
+            with cur.copy(f"COPY machines_import ({', '.join(MACHINE_COLS)}) FROM STDIN") as cp:
+                for r in rows:
+                    cp.write_row(r)
+            cur.execute(MACHINE_MERGE_SQL)
+        conn.commit()
+    return len(rows)
+
+
+CSV_ENCODING_ERROR = (
+    "El archivo no está en UTF-8. En Excel: Guardar como → "
+    "'CSV UTF-8 (delimitado por comas)'."
+)
+
+
+def read_csv_records(data: bytes):
+    """
+    Decodifica y lee un CSV subido. Devuelve (columnas, filas como dict, errores).
+    Archivos mal codificados o mal formados vuelven como error, no como excepción.
+    """
+    try:
+        reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+        records = list(reader)
+    except UnicodeDecodeError:
+        return [], [], [CSV_ENCODING_ERROR]
+    except csv.Error as e:
+        return [], [], [f"CSV inválido (línea {reader.line_num}): {e}"]
+    return reader.fieldnames or [], records, []
+
+
+def has_nul(record: dict) -> bool:
+    """Postgres no acepta \\x00 en TEXT: el COPY fallaría con todo el lote."""
+    return any(isinstance(v, str) and "\x00" in v for v in record.values())
+
+
+def parse_machines_csv(data: bytes):
+    """
+    Valida un CSV de máquinas. Devuelve (filas, errores).
+    Columnas: id_maquina, fabricante, sector, banco.
+    """
+    fieldnames, records, errors = read_csv_records(data)
+    if errors:
+        return [], errors
+    missing = set(MACHINE_COLS) - set(fieldnames)
+    if missing:
+        return [], [f"Faltan columnas: {', '.join(sorted(missing))}"]
+
+    rows = []
+    for n, r in enumerate(records, start=2):
+        if has_nul(r):
+            errors.append(f"Línea {n}: contiene caracteres nulos (\\x00).")
+            continue
+        try:
+            id_maquina = int((r["id_maquina"] or "").strip())
+        except ValueError:
+            errors.append(f"Línea {n}: id_maquina inválido.")
+            continue
+        if not 1 <= id_maquina <= ID_MAQUINA_MAX:
+            errors.append(f"Línea {n}: id_maquina fuera de rango (1 a {ID_MAQUINA_MAX}).")
+            continue
+        fabricante = (r["fabricante"] or "").strip()
+        sector = (r["sector"] or "").strip()
+        banco = (r["banco"] or "").strip()
+
+        if not fabricante or not sector or not banco:
+            errors.append(f"Línea {n}: fabricante, sector y banco son obligatorios.")
+        else:
+            rows.append((id_maquina, fabricante, sector, banco))
+    return rows, errors
+
+
+def parse_mantenciones_csv(data: bytes, valid_ids: set, default_user: str):
+    """
+    Valida un CSV de mantenciones. Devuelve (filas, errores).
+    Columnas: id_maquina, tipo, descripcion, fecha (AAAA-MM-DD), realizado_por (opcional).
+    """
+    fieldnames, records, errors = read_csv_records(data)
+    if errors:
+        return [], errors
+    missing = {"id_maquina", "tipo", "descripcion", "fecha"} - set(fieldnames)
+    if missing:
+        return [], [f"Faltan columnas: {', '.join(sorted(missing))}"]
+
+    rows = []
+    for n, r in enumerate(records, start=2):
+        if has_nul(r):
+            errors.append(f"Línea {n}: contiene caracteres nulos (\\x00).")
+            continue
+        try:
+            id_maquina = int((r["id_maquina"] or "").strip())
+            fecha = date.fromisoformat((r["fecha"] or "").strip())
+        except ValueError:
+            errors.append(f"Línea {n}: id_maquina o fecha inválidos.")
+            continue
+        tipo = (r["tipo"] or "").strip()
+        descripcion = (r["descripcion"] or "").strip()
+        realizado_por = (r.get("realizado_por") or "").strip() or default_user
+
+        if id_maquina not in valid_ids:
+            errors.append(f"Línea {n}: la máquina {id_maquina} no existe.")
+        elif tipo not in TIPOS_MANTENCION_SET:
+            errors.append(f"Línea {n}: tipo '{tipo}' inválido.")
+        elif not descripcion:
+            errors.append(f"Línea {n}: la descripción es obligatoria.")
+        else:
+            rows.append((id_maquina, tipo, descripcion, fecha, realizado_por))
+    return rows, errors
 
 
 # ----------------------------
@@ -294,23 +688,27 @@ def render_login():
     st.markdown('<p class="kr-title">🔐 KR_TGM • Login</p>', unsafe_allow_html=True)
     st.markdown('<p class="kr-sub">Ingresa tus credenciales para continuar.</p>', unsafe_allow_html=True)
 
-    c1, c2, c3 = st.columns([1, 1, 2])
-    with c1:
-        username = st.text_input("Usuario", key="login_user")
-    with c2:
-        password = st.text_input("Contraseña", type="password", key="login_pass")
-    with c3:
-        st.write("")
-        st.write("")
-        if st.button("Ingresar", use_container_width=True):
-            if not username or not password:
-                st.error("Completa usuario y contraseña.")
+    # En un form: escribir usuario/clave no provoca reruns; solo el envío.
+    with st.form("login_form"):
+        c1, c2, c3 = st.columns([1, 1, 2])
+        with c1:
+            username = st.text_input("Usuario", key="login_user").strip()
+        with c2:
+            password = st.text_input("Contraseña", type="password", key="login_pass")
+        with c3:
+            st.write("")
+            st.write("")
+            submitted = st.form_submit_button("Ingresar", use_container_width=True)
+
+    if submitted:
+        if not username or not password:
+            st.error("Completa usuario y contraseña.")
+        else:
+            if login(username, password):
+                st.success("Sesión iniciada.")
+                st.rerun()
             else:
-                if login(username, password):
-                    st.success("Sesión iniciada.")
-                    st.rerun()
-                else:
-                    st.error("Usuario o contraseña incorrectos.")
+                st.error("Usuario o contraseña incorrectos.")
 
     st.info("Admin por defecto: usuario **admin** / clave **Admin1234!** (cámbiala apenas entres).")
     st.markdown("</div>", unsafe_allow_html=True)
@@ -319,27 +717,15 @@ def render_login():
 # ----------------------------
 # PAGES
 # ----------------------------
-def page_maquinas():
-    require_login()
-
-    st.markdown('<div class="kr-card">', unsafe_allow_html=True)
-    st.markdown('<p class="kr-title">🎰 Máquinas</p>', unsafe_allow_html=True)
-    st.markdown('<p class="kr-sub">Gestiona id_maquina (numérico), fabricante, sector y banco.</p>', unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
-
-    tab1, tab2 = st.tabs(["📋 Listado / Editar", "➕ Crear"])
-
-    with tab1:
-        machines = run_fetch_machines()
-        if not machines:
-            st.warning("No hay máquinas registradas.")
-            return
-
-        labels = [f'{m["id_maquina"]} • {m["fabricante"]} • {m["sector"]} • {m["banco"]}' for m in machines]
-        idx_map = {labels[i]: machines[i] for i in range(len(machines))}
-        sel = st.selectbox("Selecciona una máquina (buscable)", labels)
-        m = idx_map[sel]
-
+# Las páginas son fragmentos: un widget de la página solo re-ejecuta esa
+# página, no el sidebar ni el resto del script. st.rerun() sigue
+# recargando la app completa (p. ej. tras guardar).
+def machine_editor(m: dict):
+    """
+    Editor de una máquina. Los campos van en un form: escribir no provoca
+    reruns; solo "Guardar" o "Eliminar".
+    """
+    with st.form("machine_form"):
         colA, colB, colC, colD = st.columns(4)
         with colA:
             st.number_input("id_maquina (PK)", value=int(m["id_maquina"]), step=1, disabled=True)
@@ -352,38 +738,98 @@ def page_maquinas():
 
         c1, c2, c3 = st.columns([1, 1, 2])
         with c1:
-            if st.button("Guardar cambios", use_container_width=True):
-                run_exec("""
-                    UPDATE machines SET fabricante=%s, sector=%s, banco=%s WHERE id_maquina=%s
-                """, (fabricante.strip(), sector.strip(), banco.strip(), int(m["id_maquina"])))
-                st.success("Máquina actualizada.")
-                st.rerun()
-
+            save = st.form_submit_button("Guardar cambios", use_container_width=True)
         with c2:
-            if st.button("Eliminar máquina", use_container_width=True):
-                try:
-                    run_exec("DELETE FROM machines WHERE id_maquina=%s;", (int(m["id_maquina"]),))
-                    st.success("Máquina eliminada.")
-                    st.rerun()
-                except Exception as e:
-                    st.error("No se pudo eliminar (puede tener mantenciones asociadas).")
-                    st.exception(e)
-
+            delete = st.form_submit_button("Eliminar máquina", use_container_width=True)
         with c3:
             st.caption("Nota: si la máquina tiene mantenciones, no se eliminará (FK).")
 
+    if save:
+        run_exec("""
+            UPDATE machines SET fabricante=%s, sector=%s, banco=%s WHERE id_maquina=%s
+        """, (fabricante.strip(), sector.strip(), banco.strip(), int(m["id_maquina"])))
+        clear_machine_caches()
+        st.success("Máquina actualizada.")
+        st.rerun()
+
+    if delete:
+        # Solo el DELETE va en el try: st.rerun() se implementa con una
+        # excepción y no debe caer en el except.
+        try:
+            run_exec("DELETE FROM machines WHERE id_maquina=%s;", (int(m["id_maquina"]),))
+        except Exception as e:
+            st.error("No se pudo eliminar (puede tener mantenciones asociadas).")
+            st.exception(e)
+        else:
+            clear_machine_caches()
+            st.success("Máquina eliminada.")
+            st.rerun()
+
+
+@st.fragment
+def page_maquinas():
+    require_login()
+
+    st.markdown('<div class="kr-card">', unsafe_allow_html=True)
+    st.markdown('<p class="kr-title">🎰 Máquinas</p>', unsafe_allow_html=True)
+    st.markdown('<p class="kr-sub">Gestiona id_maquina (numérico), fabricante, sector y banco.</p>', unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    tab1, tab2, tab3 = st.tabs(["📋 Listado / Editar", "➕ Crear", "📥 Importar CSV"])
+
+    with tab1:
+        # En un form: la consulta corre al presionar "Buscar", no en cada tecla.
+        with st.form("machines_filtro"):
+            q = st.text_input("Filtrar (id_maquina / fabricante / sector / banco)", "").strip()
+            st.form_submit_button("🔎 Buscar", use_container_width=True)
+        machines = search_machines(q)
+        if not machines:
+            st.warning("Sin resultados para ese filtro." if q else "No hay máquinas registradas.")
+        else:
+            if len(machines) == MACHINE_SEARCH_LIMIT:
+                st.caption(f"Mostrando las primeras {MACHINE_SEARCH_LIMIT}; afina el filtro.")
+            labels = [f'{m["id_maquina"]} • {m["fabricante"]} • {m["sector"]} • {m["banco"]}' for m in machines]
+            idx_map = {labels[i]: machines[i] for i in range(len(machines))}
+            sel = st.selectbox("Selecciona una máquina (buscable)", labels)
+            m = idx_map[sel]
+
+            machine_editor(m)
+
+    with tab3:
+        st.caption("Columnas: id_maquina, fabricante, sector, banco. Si el id_maquina ya existe, se actualiza.")
+        up = st.file_uploader("Archivo CSV", type=["csv"], key="machines_csv")
+        if up is not None and st.button("Importar máquinas", use_container_width=True):
+            rows, errors = parse_machines_csv(up.getvalue())
+            if errors:
+                st.error("No se importó nada. Corrige el archivo:")
+                st.write(errors[:50])
+            elif not rows:
+                st.warning("El archivo no tiene filas.")
+            else:
+                try:
+                    n = machines_upsert_many(rows)
+                except psycopg.DataError as e:
+                    st.error("No se importó nada: la base de datos rechazó un valor del archivo.")
+                    st.exception(e)
+                else:
+                    clear_machine_caches()
+                    st.success(f"{n} máquinas importadas.")
+                    st.rerun()
+
     with tab2:
-        col1, col2, col3, col4 = st.columns(4)
-        with col1:
-            new_id = st.number_input("Nuevo id_maquina", step=1)
-        with col2:
-            new_fab = st.text_input("fabricante", placeholder="IGT / Novomatic / etc.")
-        with col3:
-            new_sector = st.text_input("sector", placeholder="Ej: Terraza / Sala Principal")
-        with col4:
-            new_banco = st.text_input("banco", placeholder="Ej: Banco A / King Kong Cash")
-
-        if st.button("Crear máquina", use_container_width=True):
+        with st.form("machine_create_form"):
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                new_id = st.number_input("Nuevo id_maquina", step=1)
+            with col2:
+                new_fab = st.text_input("fabricante", placeholder="IGT / Novomatic / etc.")
+            with col3:
+                new_sector = st.text_input("sector", placeholder="Ej: Terraza / Sala Principal")
+            with col4:
+                new_banco = st.text_input("banco", placeholder="Ej: Banco A / King Kong Cash")
+            create = st.form_submit_button("Crear máquina", use_container_width=True)
+
+        if create:
             if not new_fab.strip() or not new_sector.strip() or not new_banco.strip():
                 st.error("Completa todos los campos.")
                 return
@@ -392,10 +838,12 @@ def page_maquinas():
                 INSERT INTO machines (id_maquina, fabricante, sector, banco)
                 VALUES (%s,%s,%s,%s)
             """, (int(new_id), new_fab.strip(), new_sector.strip(), new_banco.strip()))
+            clear_machine_caches()
             st.success("Máquina creada.")
             st.rerun()
 
 
+@st.fragment
 def page_mantenciones():
     require_login()
 
@@ -412,76 +860,104 @@ def page_mantenciones():
     labels = [f'{m["id_maquina"]} • {m["fabricante"]} • {m["sector"]} • {m["banco"]}' for m in machines]
     idx_map = {labels[i]: machines[i] for i in range(len(machines))}
 
-    c1, c2, c3, c4 = st.columns([2, 1, 2, 2])
-    with c1:
-        sel_label = st.selectbox("Máquina (buscable)", labels)
-        sel_machine = idx_map[sel_label]
-        id_maquina = int(sel_machine["id_maquina"])
-    with c2:
-        fecha = st.date_input("Fecha", value=date.today())
-    with c3:
-        tipo = st.selectbox("Tipo", ["Preventiva", "Correctiva", "Revisión", "Software", "Otro"])
-    with c4:
-        realizado_por = st.text_input("Realizado por", value=current_user()["username"])
-
-    descripcion = st.text_area("Descripción", height=120)
-
-    if st.button("Guardar mantención", use_container_width=True):
-        if not descripcion.strip():
-            st.error("La descripción es obligatoria.")
-            return
-
-        if not machine_exists(id_maquina):
-            st.error("No se puede guardar: la máquina seleccionada ya no existe.")
-            return
-
-        run_exec("""
+    with st.form("mantencion_form"):
+        c1, c2, c3, c4 = st.columns([2, 1, 2, 2])
+        with c1:
+            sel_label = st.selectbox("Máquina (buscable)", labels)
+            sel_machine = idx_map[sel_label]
+            id_maquina = int(sel_machine["id_maquina"])
+        with c2:
+            fecha = st.date_input("Fecha", value=date.today())
+        with c3:
+            tipo = st.selectbox("Tipo", TIPOS_MANTENCION)
+        with c4:
+            realizado_por = st.text_input("Realizado por", value=current_user()["username"])
+
+        descripcion = st.text_area("Descripción", height=120)
+        submitted = st.form_submit_button("Guardar mantención", use_container_width=True)
+
+    # Sin return en los errores: el expander de importación debe seguir visible.
+    if submitted and not descripcion.strip():
+        st.error("La descripción es obligatoria.")
+    elif submitted:
+        # Insert condicionado a que la máquina exista: un solo round-trip.
+        inserted = run_exec("""
             INSERT INTO mantenciones (id_maquina, tipo, descripcion, fecha, realizado_por)
-            VALUES (%s,%s,%s,%s,%s)
-        """, (id_maquina, tipo, descripcion.strip(), fecha, realizado_por.strip()))
-        st.success("Mantención registrada.")
-        st.rerun()
-
+            SELECT ma.id_maquina, %s, %s, %s, %s
+            FROM machines ma
+            WHERE ma.id_maquina = %s
+        """, (tipo, descripcion.strip(), fecha, realizado_por.strip(), id_maquina), prepare=True)
+        if not inserted:
+            clear_machine_caches()
+            st.error("No se puede guardar: la máquina seleccionada ya no existe.")
+        else:
+            fetch_historial.clear()
+            st.success("Mantención registrada.")
+            st.rerun()
 
-def page_historial():
-    require_login()
+    with st.expander("📥 Importar mantenciones (CSV)"):
+        st.caption("Columnas: id_maquina, tipo, descripcion, fecha (AAAA-MM-DD), realizado_por (opcional).")
+        up = st.file_uploader("Archivo CSV", type=["csv"], key="mant_csv")
+        if up is not None and st.button("Importar", use_container_width=True):
+            valid_ids = {int(m["id_maquina"]) for m in machines}
+            rows, errors = parse_mantenciones_csv(up.getvalue(), valid_ids, current_user()["username"])
+            if errors:
+                st.error("No se importó nada. Corrige el archivo:")
+                st.write(errors[:50])
+            elif not rows:
+                st.warning("El archivo no tiene filas.")
+            else:
+                # valid_ids viene del cache (hasta 30 s): si una máquina se
+                # eliminó entremedio, la FK rechaza el COPY completo.
+                try:
+                    mantenciones_bulk_create(rows)
+                except ForeignKeyViolation:
+                    clear_machine_caches()
+                    st.error("No se importó nada: una de las máquinas del archivo ya no existe. Reintenta.")
+                except psycopg.DataError as e:
+                    st.error("No se importó nada: la base de datos rechazó un valor del archivo.")
+                    st.exception(e)
+                else:
+                    fetch_historial.clear()
+                    st.success(f"{len(rows)} mantenciones importadas.")
+                    st.rerun()
 
-    st.markdown('<div class="kr-card">', unsafe_allow_html=True)
-    st.markdown('<p class="kr-title">📚 Historial</p>', unsafe_allow_html=True)
-    st.markdown('<p class="kr-sub">Historial con JOIN a máquinas.</p>', unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
 
-    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
-    with c1:
-        q = st.text_input("Buscar (id_maquina / sector / banco / descripción)", "")
-    with c2:
-        tipo = st.selectbox("Tipo", ["(Todos)", "Preventiva", "Correctiva", "Revisión", "Software", "Otro"])
-    with c3:
-        desde = st.date_input("Desde", value=date.today().replace(day=1))
-    with c4:
-        hasta = st.date_input("Hasta", value=date.today())
-
-    params = {"desde": desde, "hasta": hasta}
+@functools.lru_cache(maxsize=16)
+def historial_sql(with_tipo: bool, with_q: bool, with_cursor: bool, count: bool = False) -> str:
+    """
+    SQL del historial según los filtros activos (pocas formas posibles).
+    count=True devuelve el COUNT total de los filtros (sin cursor ni LIMIT).
+    Cada forma se prepara en el servidor desde su primera ejecución.
+    Paginación keyset: la página siguiente parte después de (fecha, id) de
+    la última fila, usando el índice en vez de saltar filas con OFFSET.
+    """
     where = ["m.fecha BETWEEN %(desde)s AND %(hasta)s"]
 
-    if tipo != "(Todos)":
+    if with_cursor:
+        where.append("(m.fecha, m.id) < (%(cur_fecha)s, %(cur_id)s)")
+
+    if with_tipo:
         where.append("m.tipo = %(tipo)s")
-        params["tipo"] = tipo
 
-    if q.strip():
+    if with_q:
         where.append("""
             (
-                ma.id_maquina::text ILIKE %(q)s OR
-                ma.fabricante ILIKE %(q)s OR
-                ma.sector ILIKE %(q)s OR
-                ma.banco ILIKE %(q)s OR
+                ma.search_blob ILIKE %(q)s OR
                 m.descripcion ILIKE %(q)s OR
                 m.realizado_por ILIKE %(q)s
             )
         """)
-        params["q"] = f"%{q.strip()}%"
 
-    sql = f"""
+    if count:
+        return f"""
+            SELECT count(*) AS total
+            FROM mantenciones m
+            JOIN machines ma ON ma.id_maquina = m.id_maquina
+            WHERE {" AND ".join(where)};
+        """
+
+    return f"""
         SELECT
             m.id,
             m.fecha,
@@ -497,10 +973,84 @@ def page_historial():
         JOIN machines ma ON ma.id_maquina = m.id_maquina
         WHERE {" AND ".join(where)}
         ORDER BY m.fecha DESC, m.id DESC
-        LIMIT 2000;
+        LIMIT %(limit)s;
     """
-    rows = run_fetchall(sql, params)
-    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+
+# Cacheado por filtros; se invalida con fetch_historial.clear() al escribir
+# mantenciones o editar/eliminar máquinas.
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_historial(desde, hasta, tipo, q: str, limit: int, cursor=None):
+    """
+    cursor: (fecha, id) de la última fila de la página anterior, o None.
+    Retorna (total de filas con esos filtros, tabla Arrow de la página).
+    El COUNT recorre todo el filtro, así que solo corre en la primera página
+    (cursor=None); con cursor el total es None y se toma de esa entrada.
+    """
+    params = {"desde": desde, "hasta": hasta, "limit": limit}
+    if tipo:
+        params["tipo"] = tipo
+    if q:
+        params["q"] = f"%{q}%"
+    if cursor:
+        params["cur_fecha"], params["cur_id"] = cursor
+
+    sql = historial_sql("tipo" in params, "q" in params, cursor is not None)
+    if cursor:
+        return None, run_fetch_table(sql, params, prepare=True)
+    count_sql = historial_sql("tipo" in params, "q" in params, False, count=True)
+    return run_fetch_count_table(count_sql, sql, params, prepare=True)
+
+
+@st.fragment
+def page_historial():
+    require_login()
+
+    st.markdown('<div class="kr-card">', unsafe_allow_html=True)
+    st.markdown('<p class="kr-title">📚 Historial</p>', unsafe_allow_html=True)
+    st.markdown('<p class="kr-sub">Historial con JOIN a máquinas.</p>', unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    # En un form: la consulta corre al presionar "Buscar", no en cada tecla.
+    with st.form("historial_filtros"):
+        c1, c2, c3, c4, c5 = st.columns([2, 1, 1, 1, 1])
+        with c1:
+            q = st.text_input("Buscar (id_maquina / sector / banco / descripción)", "")
+        with c2:
+            tipo = st.selectbox("Tipo", TIPOS_FILTRO)
+        with c3:
+            desde = st.date_input("Desde", value=date.today().replace(day=1))
+        with c4:
+            hasta = st.date_input("Hasta", value=date.today())
+        with c5:
+            page_size = st.selectbox("Filas", HIST_PAGE_SIZES, index=2)
+        st.form_submit_button("🔎 Buscar", use_container_width=True)
+
+    # Pila de cursores keyset; se reinicia cuando cambian los filtros.
+    filters = (desde, hasta, tipo, q.strip(), int(page_size))
+    if st.session_state.get("hist_filters") != filters:
+        st.session_state["hist_filters"] = filters
+        st.session_state["hist_cursors"] = [None]
+    cursors = st.session_state["hist_cursors"]
+
+    hist_args = (desde, hasta, None if tipo == TIPO_TODOS else tipo, q.strip(), int(page_size))
+    total, table = fetch_historial(*hist_args, cursors[-1])
+    if total is None:
+        # Páginas siguientes: el total sale de la entrada cacheada de la primera.
+        total, _ = fetch_historial(*hist_args, None)
+    st.dataframe(table, use_container_width=True, hide_index=True)
+
+    b1, b2, b3 = st.columns([1, 1, 4])
+    with b1:
+        if st.button("⬅️ Anterior", disabled=len(cursors) == 1, use_container_width=True):
+            cursors.pop()
+            st.rerun()
+    with b2:
+        if st.button("Siguiente ➡️", disabled=table.num_rows < int(page_size), use_container_width=True):
+            cursors.append((table.column("fecha")[-1].as_py(), table.column("id")[-1].as_py()))
+            st.rerun()
+    with b3:
+        st.caption(f"Página {len(cursors)} • {total} resultados")
 
 
 def page_usuarios_admin():
@@ -511,19 +1061,27 @@ def page_usuarios_admin():
 # ----------------------------
 # SIDEBAR NAV
 # ----------------------------
+PAGES = {
+    "🛠️ Mantenciones": page_mantenciones,
+    "📚 Historial": page_historial,
+    "🎰 Máquinas": page_maquinas,
+    "👤 Usuarios (Admin)": page_usuarios_admin,
+}
+NAV_LOGOUT = "🚪 Cerrar sesión"
+NAV_USER = ("🛠️ Mantenciones", "📚 Historial", "🎰 Máquinas", NAV_LOGOUT)
+NAV_ADMIN = ("🛠️ Mantenciones", "📚 Historial", "🎰 Máquinas", "👤 Usuarios (Admin)", NAV_LOGOUT)
+
+
 def render_sidebar_nav():
     u = current_user()
     st.sidebar.markdown("### KR_TGM")
     st.sidebar.write(f"👋 **{u['username']}**")
     st.sidebar.caption("Mantenciones • Streamlit + Supabase")
 
-    pages = ["🛠️ Mantenciones", "📚 Historial", "🎰 Máquinas", "🚪 Cerrar sesión"]
-    if u.get("is_admin") or u.get("role") == "admin":
-        pages.insert(3, "👤 Usuarios (Admin)")
+    is_admin = u.get("is_admin") or u.get("role") == "admin"
+    choice = st.sidebar.radio("Navegación", NAV_ADMIN if is_admin else NAV_USER, index=0)
 
-    choice = st.sidebar.radio("Navegación", pages, index=0)
-
-    if choice == "🚪 Cerrar sesión":
+    if choice == NAV_LOGOUT:
         logout()
         st.success("Sesión cerrada.")
         st.rerun()
@@ -540,17 +1098,7 @@ def main():
         return
 
     choice = render_sidebar_nav()
-
-    if choice == "🎰 Máquinas":
-        page_maquinas()
-    elif choice == "🛠️ Mantenciones":
-        page_mantenciones()
-    elif choice == "📚 Historial":
-        page_historial()
-    elif choice == "👤 Usuarios (Admin)":
-        page_usuarios_admin()
-    else:
-        page_mantenciones()
+    PAGES.get(choice, page_mantenciones)()
 
 
 if __name__ == "__main__":